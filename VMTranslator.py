@@ -1,69 +1,58 @@
 import sys
 import re
 import os
-from itertools import islice
+from itertools import islice, count
+from collections import deque
+from functools import lru_cache
 
 # sliding window util function
 def window(seq, n=2):
+    if isinstance(seq, list):
+        for i in range(len(seq) - n + 1):
+            yield seq[i:i + n]
+        return
     it = iter(seq)
-    result = tuple(islice(it, 0, n, 1))
+    result = deque(islice(it, 0, n, 1), maxlen=n)
     if len(result) == n:
-        yield result
+        yield tuple(result)
     for elem in it:
-        result = result[1:] + (elem,)
-        yield result
-
-# replace matching subsequences
-def window_replace(seq, match, sub, n=2):
-    it = iter(seq)
-    def advance():
-        return tuple(islice(it, 0, n, 1))
-    result = advance()
-    while len(result) == n:
-        if match(result):
-            for s in sub(result):
-                yield s
-            result = advance()
-        else:
-            yield result[0]
-            result = result[1:]
-            try:
-                result += (next(it), )
-            except StopIteration:
-                pass
-    for e in result:
-        yield e
+        result.append(elem)
+        yield tuple(result)
 
 class Command:
+    __slots__ = ('command', 'args', '_symbolic')
 
     def __init__(self, command, *args):
        self.command = command
        self.args = args
+       self._symbolic = None
 
     def symbolic(self):
-        return ' '.join([self.command] + [str(arg) for arg in self.args])
+        if self._symbolic is None:
+            self._symbolic = ' '.join([self.command] + [str(arg) for arg in self.args])
+        return self._symbolic
 
-    def visit(self, traversal):
-        member = '_' + self.command.replace('-', '_')
-        return getattr(traversal, member)(*self.args)
+_comment_re = re.compile(r'//[^\n]*')
 
 class Parser:
 
-    def __init__(self, fp):
-        self.fp = fp
+    def __init__(self, lines):
+        self.lines = iter(lines)
+
+    # split a whole vm file into the components of each non-empty line
+    @classmethod
+    def from_text(cls, text):
+        text = _comment_re.sub('', text)
+        return cls([components for components in map(str.split, text.splitlines()) if components])
 
     def __iter__(self):
         return self
 
     def __next__(self):
         while True:
-            line = next(self.fp)
-            line = re.sub('//.*$', '', line)
-            line = line.strip()
-            if len(line) == 0:
-                continue
-            line = re.sub('\s+', ' ', line)
-            components = line.split(' ')
+            components = next(self.lines)
+            # opcodes come from a small vocabulary, intern them for fast compares
+            components[0] = sys.intern(components[0])
             if len(components) == 1:
                 return Command(components[0])
             elif len(components) == 2:
@@ -84,15 +73,112 @@ _memory_segments = {
 }
 _pointer_registers = [ 'THIS', 'THAT' ]
 
+# opcodes that call or define a function
+_call_ops = frozenset(('call', 'call-ext'))
+_function_ops = frozenset(('function', 'function-ext'))
+
+# constant op sequences
+_add_asm = (
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    'A=A-1',
+    'M=D+M'
+)
+
+_sub_asm = (
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    'A=A-1',
+    'M=M-D'
+)
+
+_neg_asm = (
+    '@SP',
+    'A=M-1',
+    'M=-M'
+)
+
+_and_asm = (
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    'A=A-1',
+    'M=M&D'
+)
+
+_or_asm = (
+    '@SP',
+    'AM=M-1',
+    'D=M',
+    'A=A-1',
+    'M=M|D'
+)
+
+_not_asm = (
+    '@SP',
+    'A=M-1',
+    'M=!M'
+)
+
+_drop_asm = (
+    '@SP',
+    'AM=M-1'
+)
+
+_push_constant_0_asm = (
+    '@SP',
+    'AM=M+1',
+    'A=A-1',
+    'M=0'
+)
+
+_push_constant_1_asm = (
+    '@SP',
+    'AM=M+1',
+    'A=A-1',
+    'M=1'
+)
+
+_return_asm = (
+    '@pop_stack',
+    '0; JMP'
+)
+
+# preformatted addresses for small constants and fixed registers
+_constant_addresses = tuple('@%d' % i for i in range(1024))
+_temp_addresses = tuple('@%d' % (_temp_register + i) for i in range(8))
+_pointer_addresses = tuple('@%s' % register for register in _pointer_registers)
+_memory_segment_addresses = {segment: '@%s' % register for segment, register in _memory_segments.items()}
+
+# 'A=A+1' runs for walking short offsets from a segment base
+_address_increments = tuple(('A=A+1',) * n for n in range(10))
+
+def constant_address(i):
+    return _constant_addresses[i] if 0 <= i < 1024 else '@%d' % i
+
 def temp_register(i):
-    return '@%d' % (_temp_register + i)
+    return _temp_addresses[i]
 
 def pointer_register(i):
-    return '@%s' % _pointer_registers[i]
+    return _pointer_addresses[i]
 
 def memory_segment_address(segment):
-    return '@%s' % _memory_segments[segment]
+    return _memory_segment_addresses[segment]
+
 
+# vm commands the translator handles, each by the method _<command> with
+# dashes as underscores
+_vm_commands = (
+    'init-vm',
+    'add', 'sub', 'neg', 'eq', 'lt', 'lte', 'gt', 'gte', 'and', 'or', 'not',
+    'push', 'poke', 'ldd', 'sto', 'inc', 'dec', 'inv', 'drop', 'sdd', 'pop', 'tee',
+    'label', 'goto', 'if-goto', 'if-goto-not',
+    'if-eq-goto', 'if-lt-goto', 'if-lte-goto', 'if-gt-goto', 'if-gte-goto',
+    'function', 'function-ext', 'call', 'call-ext', 'return',
+    'inline-call', 'inline-return',
+)
 
 class ASMTranslator:
 
@@ -101,6 +187,9 @@ class ASMTranslator:
         self.function_name = ''
         self.call_index = 0
         self.label_index = 0
+        self._out = []
+        # vm command -> handler, e.g. 'if-goto' -> self._if_goto
+        self._dispatch = {command: getattr(self, '_' + command.replace('-', '_')) for command in _vm_commands}
 
     def static_address(self, i):
         return '@%s.%d' % (self.filename, i)
@@ -127,53 +216,42 @@ class ASMTranslator:
         self.label_index += 1
         return '@' + label, '(' + label + ')'
 
+    # op handlers append their instructions to self._out
     def translate(self, command):
-        return command.visit(self)
+        self._out = []
+        self._dispatch[command.command](*command.args)
+        return self._out
 
     # vm init
     def _init_vm(self):
         address, label = self.next_address_label('init_vm')
-        return [
+        self._out.extend((
             '@256',
             'D=A',
             '@SP',
             'M=D',
             self.function_call_address('Sys.init'), # jump to function
             '0; JMP'
-        ] + self._save_stack() + self._pop_stack()
+        ))
+        self._save_stack()
+        self._pop_stack()
 
     # x + y
     def _add(self):
-        return [
-            '@SP',
-            'AM=M-1',
-            'D=M',
-            'A=A-1',
-            'M=D+M'
-        ]
+        self._out.extend(_add_asm)
 
     # x - y
     def _sub(self):
-        return [
-            '@SP',
-            'AM=M-1',
-            'D=M',
-            'A=A-1',
-            'M=M-D'
-        ]
+        self._out.extend(_sub_asm)
 
     # -y
     def _neg(self):
-        return [
-            '@SP',
-            'A=M-1',
-            'M=-M',
-        ]
+        self._out.extend(_neg_asm)
 
     # x == y
     def _eq(self):
         address, label = self.next_address_label('JEQ')
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
@@ -186,489 +264,505 @@ class ASMTranslator:
             '@SP',
             'A=M-1',
             'M=!D'
-        ]
+        ))
 
     # x < y
     def _lt(self):
         address, label = self.next_address_label('JLT')
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
             'A=A-1',
             'D=M-D',
+            'M=-1', # assume true
             address,
-            'D=D; JLT',
-            'A=A+1',
-            'D=0; JMP',
-            label,
-            'D=-1',
-            '@SP',
+            'D; JLT',
+            '@SP', # otherwise false
             'A=M-1',
-            'M=D'
-        ]
+            'M=0',
+            label
+        ))
 
 
     # x <= y
     def _lte(self):
         address, label = self.next_address_label('JLE')
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
             'A=A-1',
             'D=M-D',
+            'M=-1', # assume true
             address,
-            'D=D; JLE',
-            'A=A+1',
-            'D=0; JMP',
-            label,
-            'D=-1',
-            '@SP',
+            'D; JLE',
+            '@SP', # otherwise false
             'A=M-1',
-            'M=D'
-        ]
+            'M=0',
+            label
+        ))
 
     # x > y
     def _gt(self):
         address, label = self.next_address_label('JGT')
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
             'A=A-1',
             'D=M-D',
+            'M=-1', # assume true
             address,
-            'D=D; JGT',
-            'A=A+1',
-            'D=0; JMP',
-            label,
-            'D=-1',
-            '@SP',
+            'D; JGT',
+            '@SP', # otherwise false
             'A=M-1',
-            'M=D'
-        ]
+            'M=0',
+            label
+        ))
 
     # x >= y
     def _gte(self):
         address, label = self.next_address_label('JGE')
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
             'A=A-1',
             'D=M-D',
+            'M=-1', # assume true
             address,
-            'D=D; JGE',
-            'A=A+1',
-            'D=0; JMP',
-            label,
-            'D=-1',
-            '@SP',
+            'D; JGE',
+            '@SP', # otherwise false
             'A=M-1',
-            'M=D'
-        ]
+            'M=0',
+            label
+        ))
 
     # x & y
     def _and(self):
-        return [
-            '@SP',
-            'AM=M-1',
-            'D=M',
-            'A=A-1',
-            'M=M&D'
-        ]
+        self._out.extend(_and_asm)
 
     # x | y
     def _or(self):
-        return [
-            '@SP',
-            'AM=M-1',
-            'D=M',
-            'A=A-1',
-            'M=M|D'
-        ]
+        self._out.extend(_or_asm)
 
     # !y
     def _not(self):
-        return [
-            '@SP',
-            'A=M-1',
-            'M=!M'
-        ]
+        self._out.extend(_not_asm)
 
     def _push(self, segment, i):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                value = []
-                op = 'M=0'
+                out.extend(_push_constant_0_asm)
+                return
             elif 1 == i:
-                value = []
-                op = 'M=1'
+                out.extend(_push_constant_1_asm)
+                return
             else:
-                value = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'M=D'
         else:
-            value = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'M=D'
-        return value + [
+        out.extend((
             '@SP',
             'AM=M+1',
             'A=A-1',
             op
-        ]
+        ))
 
     # directly copy one segment to another (avoid stack)
     def _poke(self, to_segment, i, from_segment, j):
+        out = self._out
         if 'constant' == from_segment:
             if 0 == j:
-                value = []
+                value = ()
                 op = 'M=0'
             elif 1 == j:
-                value = []
+                value = ()
                 op = 'M=1'
             else:
-                value = [
-                    '@%d' % j,
+                value = (
+                    constant_address(j),
                     'D=A'
-                ]
+                )
                 op = 'M=D'
         elif 'constant~' == from_segment:
-            value = [
-                '@%d' % j,
+            value = (
+                constant_address(j),
                 'D=!A'
-            ]
+            )
             op = 'M=D'
         elif 'constant-' == from_segment:
-            value = [
-                '@%d' % j,
+            value = (
+                constant_address(j),
                 'D=-A'
-            ]
+            )
             op = 'M=D'
 
         if 'constant' == to_segment:
-            return value + [
-                '@%s' % i,
+            out.extend(value)
+            out.extend((
+                constant_address(i),
                 op
-            ]
+            ))
         elif 'static' == to_segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 self.static_address(i),
                 'A=M',
                 op
-            ]
+            ))
         elif to_segment in _memory_segments:
             if 0 == i:
-                return value + [
+                out.extend(value)
+                out.extend((
                     memory_segment_address(to_segment),
                     'A=M',
                     'A=M',
                     op
-                ]
-            elif i < 8:
-                return value + [
-                    memory_segment_address(segment),
+                ))
+            elif i < 7:
+                out.extend(value)
+                out.extend((
+                    memory_segment_address(to_segment),
                     'A=M+1',
-                ] + (['A=A+1'] * (i - 1)) + [
+                ))
+                out.extend(_address_increments[i - 1])
+                out.extend((
                     'A=M',
                     op
-                ]
+                ))
             else:
-                return [
-                    memory_segment_address(segment),
+                out.extend((
+                    memory_segment_address(to_segment),
+                    'D=M',
+                    constant_address(i),
+                    'A=D+A',
                     'D=M',
-                    '@%d' % i,
-                    'D=D+A',
                     '@R13',
                     'M=D'
-                ] + value + [
+                ))
+                out.extend(value)
+                out.extend((
                     '@R13',
                     'A=M',
-                    'A=M',
                     op
-                ]
+                ))
         else:
-            return ['???']
+            out.append('???')
 
     # load d register
     def _ldd(self, segment, i):
+        out = self._out
         if 'constant' == segment:
             if i == 0:
-                return ['D=0']
+                out.append('D=0')
             elif i == 1:
-                return ['D=1']
+                out.append('D=1')
             else:
-                return [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
         elif 'constant~' == segment:
-            return [
-                '@%d' % i,
+            out.extend((
+                constant_address(i),
                 'D=!A'
-            ]
+            ))
         elif 'constant-' == segment:
-            return [
-                '@%d' % i,
+            out.extend((
+                constant_address(i),
                 'D=-A'
-            ]
+            ))
         elif 'static' == segment:
-            return [
+            out.extend((
                 self.static_address(i),
                 'D=M',
-            ]
+            ))
         elif 'temp' == segment:
-            return [
+            out.extend((
                 temp_register(i),
                 'D=M',
-            ]
+            ))
         elif 'pointer' == segment:
-            return [
+            out.extend((
                 pointer_register(i),
                 'D=M',
-            ]
+            ))
         elif segment in _memory_segments:
             if 0 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M',
                     'D=M',
-                ]
+                ))
             elif 1 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M+1',
                     'D=M',
-                ]
+                ))
             else:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'D=M',
-                    '@%d' % i,
+                    constant_address(i),
                     'A=D+A',
                     'D=M',
-                ]
+                ))
         else:
-            return ['???']
+            out.append('???')
 
     # write to address
     def _sto(self, segment, i, op='M=D'):
+        out = self._out
         if 'constant' == segment:
-            return [
-                '@%d' % i,
+            out.extend((
+                constant_address(i),
                 op
-            ]
+            ))
+            return
         elif 'static' == segment:
-            return [
+            out.extend((
                 self.static_address(i),
                 'A=M',
                 op
-            ]
+            ))
+            return
         elif segment in _memory_segments:
             if 0 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M',
                     'A=M',
                     op
-                ]
+                ))
+                return
             elif 1 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M+1',
                     'A=M',
                     op
-                ]
-        return ['???']
+                ))
+                return
+        out.append('???')
 
     # increment a segment by step
     def _inc(self, segment, i, step):
+        out = self._out
         if step > 1:
-            value = [
-                '@%d' % step,
+            value = (
+                constant_address(step),
                 'D=A'
-            ]
+            )
             op = 'M=M+D'
         else:
-            value = []
+            value = ()
             op = 'M=M+1'
         if 'static' == segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 self.static_address(i),
                 op
-            ]
+            ))
+            return
         elif 'temp' == segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 temp_register(i),
                 op
-            ]
+            ))
+            return
         elif 'pointer' == segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 pointer_register(i),
                 op
-            ]
+            ))
+            return
         elif segment in _memory_segments:
             if 0 == i:
-                return value + [
+                out.extend(value)
+                out.extend((
                     memory_segment_address(segment),
                     'A=M',
                     op
-                ]
+                ))
+                return
             elif 1 == i:
-                return value + [
+                out.extend(value)
+                out.extend((
                     memory_segment_address(segment),
                     'A=M+1',
                     op
-                ]
+                ))
+                return
             elif 1 == step:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'D=M',
-                    '@%d' % i,
+                    constant_address(i),
                     'A=D+A',
                     'M=M+1',
-                ]
+                ))
+                return
             # not going to handle more complex case
-        return ['???']
+        out.append('???')
 
     # decrement a segment by step
     def _dec(self, segment, i, step):
+        out = self._out
         if step > 1:
-            value = [
-                '@%d' % step,
+            value = (
+                constant_address(step),
                 'D=A'
-            ]
+            )
             op = 'M=M-D'
         else:
-            value = []
+            value = ()
             op = 'M=M-1'
         if 'static' == segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 self.static_address(i),
                 op
-            ]
+            ))
+            return
         elif 'temp' == segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 temp_register(i),
                 op
-            ]
+            ))
+            return
         elif 'pointer' == segment:
-            return value + [
+            out.extend(value)
+            out.extend((
                 pointer_register(i),
                 op
-            ]
+            ))
+            return
         elif segment in _memory_segments:
             if 0 == i:
-                return value + [
+                out.extend(value)
+                out.extend((
                     memory_segment_address(segment),
                     'A=M',
                     op
-                ]
+                ))
+                return
             elif 1 == i:
-                return value + [
+                out.extend(value)
+                out.extend((
                     memory_segment_address(segment),
                     'A=M+1',
                     op
-                ]
+                ))
+                return
             elif 1 == step:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'D=M',
-                    '@%d' % i,
+                    constant_address(i),
                     'A=D+A',
                     'M=M-1',
-                ]
+                ))
+                return
             # not going to handle more complex case
-        return ['???']
+        out.append('???')
 
     # invert a segment
     def _inv(self, segment, i):
+        out = self._out
         if 'static' == segment:
-            return [
+            out.extend((
                 self.static_address(i),
                 'M=!M'
-            ]
+            ))
         elif 'temp' == segment:
-            return [
+            out.extend((
                 temp_register(i),
                 'M=!M'
-            ]
+            ))
         elif 'pointer' == segment:
-            return [
+            out.extend((
                 pointer_register(i),
                 'M=!M'
-            ]
+            ))
         elif segment in _memory_segments:
             if 0 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M',
                     'M=!M'
-                ]
+                ))
             elif 1 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M+1',
                     'M=!M'
-            ]
+                ))
             else:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'D=M',
-                    '@%d' % i,
+                    constant_address(i),
                     'A=D+A',
                     'M=!M'
-                ]
-        return ['???']
+                ))
+        else:
+            out.append('???')
 
     # drop the top of the stack
     def _drop(self):
-        return [
-            '@SP',
-            'AM=M-1'
-        ]
+        self._out.extend(_drop_asm)
 
     # store contents of d register in segment
     def _sdd(self, segment, i, op='M=D'):
+        out = self._out
         if 'static' == segment:
-            return [
+            out.extend((
                 self.static_address(i),
                 op
-            ]
+            ))
         elif 'temp' == segment:
-            return [
+            out.extend((
                 temp_register(i),
                 op
-            ]
+            ))
         elif 'pointer' == segment:
-            return [
+            out.extend((
                 pointer_register(i),
                 op
-            ]
+            ))
         elif segment in _memory_segments:
             if 0 == i:
-                return [
+                out.extend((
                     memory_segment_address(segment),
                     'A=M',
                     op
-                ]
-            elif i < 10:
-                return [
+                ))
+            elif i < 11:
+                out.extend((
                     memory_segment_address(segment),
                     'A=M+1'
-                ] + (['A=A+1'] * (i - 1)) + [
-                    op
-                ]
+                ))
+                out.extend(_address_increments[i - 1])
+                out.append(op)
             else:
-                return [
+                out.extend((
                     '@R14',
                     'M=D',
                     memory_segment_address(segment),
                     'D=M',
-                    '@%d' % i,
+                    constant_address(i),
                     'D=D+A',
                     '@R13',
                     'M=D',
@@ -677,213 +771,242 @@ class ASMTranslator:
                     '@R13',
                     'A=M',
                     op
-                ]
+                ))
         else:
-            return ['???']
+            out.append('???')
+
+    # store the address of a segment offset in R13
+    def _r13_address(self, segment, i):
+        self._out.extend((
+            memory_segment_address(segment),
+            'D=M',
+            constant_address(i),
+            'D=D+A',
+            '@R13',
+            'M=D'
+        ))
 
     def _pop(self, segment, i):
-        return [
+        if segment in _memory_segments and i >= 8:
+            # d is free before the pop, so compute the address first
+            self._r13_address(segment, i)
+            self._out.extend((
+                '@SP',
+                'AM=M-1',
+                'D=M',
+                '@R13',
+                'A=M',
+                'M=D'
+            ))
+            return
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
-        ] + self._sdd(segment, i)
+        ))
+        self._sdd(segment, i)
 
     def _tee(self, segment, i):
-        return [
+        if segment in _memory_segments and i >= 8:
+            self._r13_address(segment, i)
+            self._out.extend((
+                '@SP',
+                'A=M-1',
+                'D=M',
+                '@R13',
+                'A=M',
+                'M=D'
+            ))
+            return
+        self._out.extend((
             '@SP',
             'A=M-1',
             'D=M',
-        ] + self._sdd(segment, i)
+        ))
+        self._sdd(segment, i)
 
     def _label(self, label):
-        return [self.label_label(label)]
+        self._out.append(self.label_label(label))
 
     def _goto(self, label):
-        return [
+        self._out.extend((
             self.label_address(label),
             '0; JMP'
-        ]
+        ))
 
     def _if_eq_goto(self, segment, i, label):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                load = []
                 op = 'D=M'
             elif 1 == i:
-                load = []
                 op = 'D=M-1'
             else:
-                load = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'D=M-D'
         else:
-            load = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'D=M-D'
-        return load + [
+        out.extend((
             '@SP',
             'AM=M-1',
             op,
             self.label_address(label),
             'D; JEQ'
-        ]
+        ))
 
     def _if_lt_goto(self, segment, i, label):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                load = []
                 op = 'D=M'
             elif 1 == i:
-                load = []
                 op = 'D=M-1'
             else:
-                load = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'D=M-D'
         else:
-            load = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'D=M-D'
-        return load + [
+        out.extend((
             '@SP',
             'AM=M-1',
             op,
             self.label_address(label),
             'D; JLT'
-        ]
+        ))
 
     def _if_lte_goto(self, segment, i, label):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                load = []
                 op = 'D=M'
             elif 1 == i:
-                load = []
                 op = 'D=M-1'
             else:
-                load = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'D=M-D'
         else:
-            load = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'D=M-D'
-        return load + [
+        out.extend((
             '@SP',
             'AM=M-1',
             op,
             self.label_address(label),
             'D; JLE'
-        ]
+        ))
 
     def _if_gt_goto(self, segment, i, label):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                load = []
                 op = 'D=M'
             elif 1 == i:
-                load = []
                 op = 'D=M-1'
             else:
-                load = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'D=M-D'
         else:
-            load = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'D=M-D'
-        return load + [
+        out.extend((
             '@SP',
             'AM=M-1',
             op,
             self.label_address(label),
             'D; JGT'
-        ]
+        ))
 
     def _if_gte_goto(self, segment, i, label):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                load = []
                 op = 'D=M'
             elif 1 == i:
-                load = []
                 op = 'D=M-1'
             else:
-                load = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'D=M-D'
         else:
-            load = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'D=M-D'
-        return load + [
+        out.extend((
             '@SP',
             'AM=M-1',
             op,
             self.label_address(label),
             'D; JGE'
-        ]
+        ))
 
     def _if_gte_goto(self, segment, i, label):
+        out = self._out
         if 'constant' == segment:
             if 0 == i:
-                load = []
                 op = 'D=M'
             elif 1 == i:
-                load = []
                 op = 'D=M-1'
             else:
-                load = [
-                    '@%d' % i,
+                out.extend((
+                    constant_address(i),
                     'D=A'
-                ]
+                ))
                 op = 'D=M-D'
         else:
-            load = self._ldd(segment, i)
+            self._ldd(segment, i)
             op = 'D=M-D'
-        return load + [
+        out.extend((
             '@SP',
             'AM=M-1',
             op,
             self.label_address(label),
             'D; JGE'
-        ]
+        ))
 
     def _if_goto(self, label):
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
             self.label_address(label),
             'D; JNE'
-        ]
+        ))
 
     def _if_goto_not(self, label):
-        return [
+        self._out.extend((
             '@SP',
             'AM=M-1',
             'D=M',
             self.label_address(label),
             'D; JEQ'
-        ]
+        ))
 
     # function that saves its caller stack
     def _function_ext(self, function_name, vars, args):
+        out = self._out
         address, label = self.next_return_address_label()
         self.function_name = function_name
-        setup = [
-            self.function_declaration_label()
-        ]
+        out.append(self.function_declaration_label())
         if function_name != 'Sys.init':
-            setup += [
+            out.extend((
                 '@R13', # save call return address R13
                 'M=D',
-                '@%d' % (5 + args), # need space for return value
+                constant_address(5 + args), # need space for return value
                 'D=A',
                 '@R14',
                 'M=D',
@@ -892,79 +1015,78 @@ class ASMTranslator:
                 '@save_stack', # jump to stack save
                 '0; JMP',
                 label
-            ]
+            ))
         if 0 == vars:
-            return setup
-        setup += [
+            return
+        out.extend((
             '@SP', # ready to zero lcl vars
             'A=M',
-        ]
+        ))
         for i in range(0, vars):
-            setup += [
+            out.extend((
                 'M=0', # now zero var
                 'AD=A+1'
-            ]
-        setup += [
+            ))
+        out.extend((
             '@SP',
             'M=D'
-        ]
-        return setup
+        ))
 
     def _function(self, function_name, vars):
+        out = self._out
         self.function_name = function_name
-        setup = [
-            self.function_declaration_label()
-        ]
+        out.append(self.function_declaration_label())
         if 0 == vars:
-            return setup
-        setup += [
+            return
+        out.extend((
             '@SP', # ready to zero lcl vars
             'A=M',
-        ]
+        ))
         for i in range(0, vars):
-            setup += [
+            out.extend((
                 'M=0', # now zero var
                 'AD=A+1'
-            ]
-        setup += [
+            ))
+        out.extend((
             '@SP',
             'M=D'
-        ]
-        return setup
+        ))
 
     def _push_registers(self, *addresses):
-        return list([i for a in addresses for i in self._push_register(a)])
+        for address in addresses:
+            self._push_register(address)
 
     def _push_register(self, address):
-        return [
+        self._out.extend((
             address,
             'D=M',
             '@SP',
             'AM=M+1',
             'A=A-1',
             'M=D'
-        ]
+        ))
 
     def _pop_registers_lcl(self, *addresses):
-        return list([i for a in addresses for i in self._pop_register_lcl(a)])
+        for address in addresses:
+            self._pop_register_lcl(address)
 
     def _pop_register_lcl(self, address):
-        return [
+        self._out.extend((
             '@LCL',
             'AM=M-1',
             'D=M',
             address,
             'M=D'
-        ]
+        ))
 
     def _call(self, function_name, args):
         address, label = self.next_return_address_label()
-        return [
+        self._out.extend((
             self.function_call_address(function_name), # jump to function
             'D=A',
             '@R13',
             'M=D',
-            '@%d' % (5 + args), # need space for return value
+            constant_address(5 + args), # need space for return value
             'D=A',
             '@R14',
             'M=D',
@@ -973,21 +1095,22 @@ class ASMTranslator:
             '@save_stack', # jump to stack save
             '0; JMP',
             label
-        ]
+        ))
 
     def _call_ext(self, function_name):
         address, label = self.next_return_address_label()
-        return [
+        self._out.extend((
             address, # leave return address in data register
             'D=A',
             self.function_call_address(function_name), # jump to function
             '0; JMP',
             label
-        ]
+        ))
 
     def _save_stack(self):
         address, label = self.next_address_label('save_stack')
-        return [
+        out = self._out
+        out.extend((
             '(save_stack)',
             '@R15', # push return address (should be in d register)
             'M=D',
@@ -997,7 +1120,9 @@ class ASMTranslator:
             'AM=M+1',
             'A=A-1',
             'M=D'
-        ] + self._push_registers('@LCL', '@ARG', '@THIS', '@THAT') + [
+        ))
+        self._push_registers('@LCL', '@ARG', '@THIS', '@THAT')
+        out.extend((
             '@SP', # set new arg segment
             'D=M',
             '@R14', # need space for return value
@@ -1011,10 +1136,11 @@ class ASMTranslator:
             '@R15', # jump to function
             'A=M',
             '0; JMP'
-        ]
+        ))
 
     def _pop_stack(self):
-        return [
+        out = self._out
+        out.extend((
             '(pop_stack)',
             '@LCL', # save return address
             'D=M',
@@ -1032,67 +1158,265 @@ class ASMTranslator:
             'D=A+1',
             '@SP', # save SP
             'M=D',
-        ] + self._pop_registers_lcl('@THAT', '@THIS', '@ARG', '@LCL') + [
+        ))
+        self._pop_registers_lcl('@THAT', '@THIS', '@ARG', '@LCL')
+        out.extend((
             '@R13', # get return address
             'A=M',
             '0; JMP'
-        ]
+        ))
 
     def _return(self):
-        return [
-            '@pop_stack',
-            '0; JMP'
-        ]
+        self._out.extend(_return_asm)
 
     # meta op - pushes new file/function scope for inline calls
     def _inline_call(self, filename, function_name):
         self.filename = filename
         self.function_name = function_name
-        return []
 
     # meta op -  file/function scope for inline calls
     def _inline_return(self, filename, function_name):
         self.filename = filename
         self.function_name = function_name
-        return []
 
 
 
-# function categorizations
-def match_code(expr, commands, exclude=None):
-    if len(expr) != len(commands):
+_regex_metachars = set('.^$*+?{}[]()|\\')
+
+def is_literal(pattern):
+    return not any(c in _regex_metachars for c in pattern)
+
+# reduce a pattern to the cheapest equivalent test on a string
+def compile_text_pattern(pattern):
+    if is_literal(pattern):
+        return lambda s: s == pattern
+    prefix = pattern[:-2]
+    if pattern.endswith('.*') and is_literal(prefix):
+        return lambda s: s.startswith(prefix)
+    return re.compile(pattern).match
+
+# opcodes a pattern can start with, or None if it is not restricted
+def pattern_opcodes(pattern):
+    head = pattern.split(' ', 1)[0]
+    if is_literal(head):
+        return [head]
+    alternatives = re.fullmatch(r'\(([\w|-]+)\)', head)
+    if alternatives:
+        return alternatives.group(1).split('|')
+    return None
+
+# argument positions the parser converts to int, by argument count
+_int_arg_positions = {2: (1,), 3: (1, 2), 4: (1, 3)}
+
+# the args tuple the parser would produce for literal argument text, or None
+# if it wouldn't parse
+def literal_args(text):
+    args = text.split(' ')
+    positions = _int_arg_positions.get(len(args), ())
+    try:
+        return tuple(int(arg) if i in positions else arg for (i, arg) in enumerate(args))
+    except ValueError:
+        return None
+
+# test a command's opcode by set lookup first, and its arguments only if
+# the pattern constrains them
+def compile_pattern(pattern):
+    head, space, rest = pattern.partition(' ')
+    opcodes = pattern_opcodes(head)
+    if opcodes is None:
+        test = compile_text_pattern(pattern)
+        return lambda command: test(command.symbolic())
+    opcodes = frozenset(opcodes)
+    if not space:
+        return lambda command: command.command in opcodes and len(command.args) == 0
+    if rest == '.*':
+        return lambda command: command.command in opcodes and len(command.args) > 0
+    args = literal_args(rest) if is_literal(rest) else None
+    if args is not None:
+        return lambda command: command.command in opcodes and command.args == args
+    test = compile_text_pattern(rest)
+    return lambda command: (
+        command.command in opcodes and len(command.args) > 0
+        and test(command.symbolic()[len(command.command) + 1:]))
+
+# compile each pattern list once
+@lru_cache(maxsize=None)
+def _compile_expr(expr):
+    return tuple(compile_pattern(pattern) for pattern in expr)
+
+def match_compiled(predicates, commands, exclude=None):
+    if len(predicates) != len(commands):
         return False
-    if all([re.match(pattern, command.symbolic()) for (pattern, command) in zip(expr, commands)]):
+    if all(predicate(command) for (predicate, command) in zip(predicates, commands)):
         return exclude is None or not exclude(commands)
     return False
 
-def rewrite(expr, commands, replace, exclude=None):
-    return window_replace(commands, lambda w: match_code(expr, w, exclude), replace, len(expr))
+# function categorizations
+def match_code(expr, commands, exclude=None):
+    return match_compiled(_compile_expr(tuple(expr)), commands, exclude)
+
+# specialize a rule's patterns into one function that returns the matching
+# window from the top of a reversed command stack, or None
+def compile_matcher(expr, exclude):
+    predicates = _compile_expr(tuple(expr))
+    n = len(predicates)
+    if n == 2:
+        p0, p1 = predicates
+        def match(pending):
+            if len(pending) >= 2 and p0(pending[-1]) and p1(pending[-2]):
+                w = [pending[-1], pending[-2]]
+                if exclude is None or not exclude(w):
+                    return w
+            return None
+    elif n == 3:
+        p0, p1, p2 = predicates
+        def match(pending):
+            if len(pending) >= 3 and p0(pending[-1]) and p1(pending[-2]) and p2(pending[-3]):
+                w = [pending[-1], pending[-2], pending[-3]]
+                if exclude is None or not exclude(w):
+                    return w
+            return None
+    else:
+        def match(pending):
+            w = pending[:-n - 1:-1]
+            return w if match_compiled(predicates, w, exclude) else None
+    return match
+
+# compile rules and group them by the opcode of their first command, keeping
+# priority order
+def index_rules(rules):
+    leading = [pattern_opcodes(expr[0]) for (expr, replace, exclude) in rules]
+    rules = [(rank, len(expr), compile_matcher(expr, exclude), replace) for (rank, (expr, replace, exclude)) in enumerate(rules)]
+    opcodes = set(opcode for opcodes in leading if opcodes is not None for opcode in opcodes)
+    index = {
+        opcode: [rule for (rule, opcodes) in zip(rules, leading) if opcodes is None or opcode in opcodes]
+        for opcode in opcodes
+    }
+    index[None] = [rule for (rule, opcodes) in zip(rules, leading) if opcodes is None]
+    return index
+
+# true if a higher priority rule matches a window starting inside the n
+# commands on top of pending - the old pass per rule would have applied it
+# first, e.g. 'pop local 3' 'push local 3' 'eq' 'if-goto L1' must become
+# 'pop local 3' 'if-eq-goto local 3 L1' rather than 'tee local 3' 'eq' 'if-goto L1'
+def preempted(rules, pending, rank, n, lookback):
+    for k in range(1, n):
+        top = len(pending) - k
+        view = pending[max(0, top - lookback - 1):top]
+        for (other, m, match, replace) in rules.get(view[-1].command, rules[None]):
+            if other >= rank:
+                break
+            if match(view) is not None:
+                return True
+    return False
+
+# replace matching subsequences in a single pass, earlier rules take priority
+def rewrite(rules, commands):
+    lookback = max(n for group in rules.values() for (rank, n, match, replace) in group) - 1
+    pending = commands[::-1]
+    result = []
+    while len(pending) > 0:
+        for (rank, n, match, replace) in rules.get(pending[-1].command, rules[None]):
+            w = match(pending)
+            if w is not None and not preempted(rules, pending, rank, n, lookback):
+                del pending[-n:]
+                pending.extend(reversed(replace(w)))
+                # step back so the replacement is matched against what precedes it
+                back = result[max(0, len(result) - lookback):]
+                del result[len(result) - len(back):]
+                pending.extend(reversed(back))
+                break
+        else:
+            result.append(pending.pop())
+    return result
 
 def scan(label, expr, commands, exclude=None):
     for w in window(commands, len(expr)):
         if match_code(expr, w, exclude=exclude):
             print(f'{label}: {[command.symbolic() for command in w]}')
 
-def is_constant_accessor(function):
-    return match_code(['function.*', 'push constant .*', 'return'], function.commands)
+# accessor kinds, keyed by the length of their function body
+_accessor_patterns = {
+    3: (('constant', ['function.*', 'push constant .*', 'return']),
+        ('static', ['function.*', 'push static .*', 'return'])),
+    5: (('member', ['function.*', 'push argument 0', 'pop pointer 0', 'push this .*', 'return']),),
+}
 
-def is_static_accessor(function):
-    return match_code(['function.*', 'push static .*', 'return'], function.commands)
+def classify_accessor(function):
+    for kind, expr in _accessor_patterns.get(len(function.commands), ()):
+        if match_code(expr, function.commands):
+            return kind
+    return None
+
+# accessor kind -> commands that replace a call to it
+_inline_builders = {
+    'constant': lambda function: [function.commands[1]],
+    'static': lambda function: [function.commands[1]],
+    'member': lambda function: [Command('pop', 'pointer', 1), Command('push', 'that', function.commands[3].args[1])],
+}
 
-def is_member_accessor(function):
-    return match_code(['function.*', 'push argument 0', 'pop pointer 0', 'push this .*', 'return'], function.commands)
+# peephole rules: (patterns, replace, exclude), compiled once at import
+_peephole_rules = index_rules([
+    # push constant not -> push constant~
+    (['push constant .*', 'not'],
+     lambda w: [Command('push', 'constant~', w[0].args[1])],
+     None),
+    # push constant neg -> push constant-
+    (['push constant .*', 'neg'],
+     lambda w: [Command('push', 'constant-', w[0].args[1])],
+     None),
+    # push constant 0 add -> noop
+    (['push constant 0', 'add'],
+     lambda w: [],
+     None),
+    # push constant 0 not => true
+    (['push constant 0', 'not'],
+     lambda w: [Command('push', 'constant~', 0)],
+     None),
+    # lt not => gte
+    (['lt', 'not'],
+     lambda w: [Command('gte')],
+     None),
+    # gt not => lte
+    (['gt', 'not'],
+     lambda w: [Command('lte')],
+     None),
+    # rewrite if x ? c (for constant c)
+    (['push .*', '(eq|lt|gt|lte|gte)', 'if-goto .*'],
+     lambda w: [Command(sys.intern(f'if-{w[1].command}-goto'), w[0].args[0], w[0].args[1], w[2].args[0])],
+     None),
+    # push pop -> ldd sdd
+    (['push .*', 'pop .*'],
+     lambda w: [Command(f'ldd', *w[0].args), Command('sdd', *w[1].args)],
+     None),
+    # push inline-call pop -> ldd inline-call sdd
+    (['push .*', 'inline-call .*', 'pop .*'],
+     lambda w: [Command(f'ldd', *w[0].args), w[1], Command('sdd', *w[2].args)],
+     None),
+    # pop push -> tee
+    (['pop .*', 'push .*'],
+     lambda w: [Command(f'tee', *w[0].args)],
+     lambda w: w[0].args != w[1].args),
+    # if-goto goto label
+    (['if-goto .*', 'goto .*', 'label .*'],
+     lambda w: [Command(f'if-goto-not', *w[1].args)],
+     lambda w: w[0].args != w[2].args),
+])
+
+# marks a function that has not been checked for inlining yet
+_unchecked = object()
 
 class Optimizer:
 
     def __init__(self):
-        pass
+        # called function name -> inline commands, or None if it can't be inlined
+        self._inline_cache = {}
 
     def inline(self, function, functions):
         commands = []
         dependencies = []
         for command in function.commands:
-            if command.command in ['call', 'call-ext']:
+            if command.command in _call_ops:
                 called_function_name = command.args[0]
                 inline_function = functions[called_function_name]
                 inline_commands = self.try_inline(inline_function)
@@ -1108,76 +1432,19 @@ class Optimizer:
         function.dependencies = dependencies
 
     def optimize(self, function):
-        commands = function.commands
-        # push constant not -> push constant~
-        commands = list(rewrite(
-            ['push constant .*', 'not'],
-            commands,
-            lambda w: [Command('push', 'constant~', w[0].args[1])]))
-        # push constant neg -> push constant-
-        commands = list(rewrite(
-            ['push constant .*', 'neg'],
-            commands,
-            lambda w: [Command('push', 'constant-', w[0].args[1])]))
-        # push constant 0 add -> noop
-        commands = list(rewrite(
-            ['push constant 0', 'add'],
-            commands,
-            lambda w: []))
-        # push constant 0 not => true
-        commands = list(rewrite(
-            ['push constant 0', 'not'],
-            commands,
-            lambda w: [Command('push', 'constant~', 0)]))
-        # lt not => gte
-        commands = list(rewrite(
-            ['lt', 'not'],
-            commands,
-            lambda w: [Command('gte')]))
-        # gt not => lte
-        commands = list(rewrite(
-            ['gt', 'not'],
-            commands,
-            lambda w: [Command('lte')]))
-        # rewrite if x ? c (for constant c)
-        commands = list(rewrite(
-            ['push .*', '(eq|lt|gt|lte|gte)', 'if-goto .*'],
-            commands,
-            lambda w: [Command(f'if-{w[1].command}-goto', w[0].args[0], w[0].args[1], w[2].args[0])]))
-        # push pop -> ldd sdd
-        commands = list(rewrite(
-            ['push .*', 'pop .*'],
-            commands,
-            lambda w: [Command(f'ldd', *w[0].args), Command('sdd', *w[1].args)]))
-        # push inline-call pop -> ldd inline-call sdd
-        commands = list(rewrite(
-            ['push .*', 'inline-call .*', 'pop .*'],
-            commands,
-            lambda w: [Command(f'ldd', *w[0].args), w[1], Command('sdd', *w[2].args)]))
-        # pop push -> tee
-        commands = list(rewrite(
-            ['pop .*', 'push .*'],
-            commands,
-            lambda w: [Command(f'tee', *w[0].args)],
-            lambda w: w[0].args != w[1].args))
-        # if-goto goto label
-        commands = list(rewrite(
-            ['if-goto .*', 'goto .*', 'label .*'],
-            commands,
-            lambda w: [Command(f'if-goto-not', *w[1].args)],
-            lambda w: w[0].args != w[2].args))
+        commands = rewrite(_peephole_rules, function.commands)
         # debugging
         # self.optimize_debug(commands)
         function.commands = commands
 
     def try_inline(self, function):
-        if is_constant_accessor(function):
-            return [function.commands[1]]
-        if is_static_accessor(function):
-            return [function.commands[1]]
-        if is_member_accessor(function):
-            return [Command('pop', 'pointer', 1), Command('push', 'that', function.commands[3].args[1])]
-        return None
+        cached = self._inline_cache.get(function.function_name, _unchecked)
+        if cached is _unchecked:
+            kind = classify_accessor(function)
+            cached = _inline_builders[kind](function) if kind else None
+            self._inline_cache[function.function_name] = cached
+        # hand out copies so callers can't alias the cached commands
+        return list(cached) if cached is not None else None
 
     # debugging function - report on sequences that might be interesting
     def optimize_debug(self, commands):
@@ -1199,6 +1466,7 @@ class Optimizer:
         scan('s_mulby2_b', ['push constant .*', 'push .*', 'call Math.multiply 2'], commands)
 
 class Function:
+    __slots__ = ('filename', 'function_name', 'commands', 'dependencies')
 
     def __init__(self, filename, function_name):
         self.filename = filename
@@ -1208,27 +1476,23 @@ class Function:
 
     def append(self, command):
         self.commands.append(command)
-        if command.command in ['call', 'call-ext']:
-            function_name = command.args[0]
-            self.dependencies.add(function_name)
 
-    def translate(self, translator, out, global_line_count):
+    # yields (is_instruction, text) for each line; numbering is left to the caller
+    def translate(self, translator):
         print(f'translating: {self.function_name}')
         translator.filename = self.filename
         translator.function_name = self.function_name
-        out.write(f'// Begin: {self.function_name}\n')
-        line_count = 0
+        instruction_count = 0
+        yield False, f'// Begin: {self.function_name}'
         for command in self.commands:
-            out.write(f'// {command.symbolic()}\n')
+            yield False, f'// {command.symbolic()}'
             for instruction in translator.translate(command):
-                    out.write(instruction)
-                    if not instruction.startswith('('):
-                        out.write(f' // {global_line_count}')
-                        global_line_count += 1
-                        line_count += 1
-                    out.write('\n')
-        out.write(f'// End: {self.function_name} / {line_count} lines\n')
-        return global_line_count
+                if instruction[0] == '(':
+                    yield False, instruction
+                else:
+                    yield True, instruction
+                    instruction_count += 1
+        yield False, f'// End: {self.function_name} / {instruction_count} lines'
 
 class Preassembler:
 
@@ -1237,23 +1501,28 @@ class Preassembler:
         self.current_function = None
 
     def reachable_functions(self, start_function):
-        seen = set()
+        seen = {start_function}
         frontier = [start_function]
         while len(frontier) > 0:
-            function_name = frontier.pop()
-            if function_name in seen:
-                continue
-            seen.add(function_name)
-            frontier.extend(self.functions[function_name].dependencies)
+            # expand a whole level at a time with set operations
+            new = set().union(*(self.functions[function_name].dependencies for function_name in frontier)) - seen
+            seen |= new
+            frontier = list(new)
         return seen
 
     def add(self, command):
-        if command.command in ['function', 'function-ext']:
+        if command.command in _function_ops:
             function_name = command.args[0]
             self.current_function = Function(self.filename, function_name)
             self.functions[function_name] = self.current_function
         self.current_function.append(command)
 
+# number the instructions from a shared counter and write the lines in one go
+def write_numbered(lines, out, line_numbers):
+    buf = [f'{text} // {next(line_numbers)}' if is_instruction else text for is_instruction, text in lines]
+    buf.append('')
+    out.write('\n'.join(buf).encode())
+
 def translate(program, init_vm, vm_files, out):
     preassembler = Preassembler()
 
@@ -1263,35 +1532,38 @@ def translate(program, init_vm, vm_files, out):
         preassembler.filename = filename
         preassembler.function_name = filename
         with open(vm_file) as fp:
-            parser = Parser(fp)
+            parser = Parser.from_text(fp.read())
             for command in parser:
                 preassembler.add(command)
 
+    # collect each function's callees in one pass over its commands
+    for function in preassembler.functions.values():
+        function.dependencies = {command.args[0] for command in function.commands if command.command in _call_ops}
+
     # optimizer inline pass
     optimizer = Optimizer()
     for function_name in preassembler.reachable_functions('Sys.init'):
         function = preassembler.functions[function_name]
         optimizer.inline(function, preassembler.functions)
-    for function_name in preassembler.reachable_functions('Sys.init'):
+    # inlining can drop functions, so walk the call graph once more and
+    # reuse the result for both the optimize and emit passes
+    reachable = preassembler.reachable_functions('Sys.init')
+    for function_name in reachable:
         function = preassembler.functions[function_name]
         optimizer.optimize(function)
 
     # emit preamble
-    out.write('// Program: %s\n' % program)
+    out.write(('// Program: %s\n' % program).encode())
     translator = ASMTranslator()
-    global_line_count = 0
+    line_numbers = count()
     if init_vm:
-        for instruction in translator._init_vm():
-            out.write(instruction)
-            if not instruction.startswith('('):
-                out.write(f' // {global_line_count}')
-                global_line_count += 1
-            out.write('\n')
+        preamble = translator.translate(Command('init-vm'))
+        write_numbered(((instruction[0] != '(', instruction) for instruction in preamble), out, line_numbers)
 
     # emit all functions reachable from Sys.init
-    for function_name in preassembler.reachable_functions('Sys.init'):
+    for function_name in reachable:
         function = preassembler.functions[function_name]
-        global_line_count = function.translate(translator, out, global_line_count)
+        write_numbered(function.translate(translator), out, line_numbers)
 
 if __name__ == '__main__':
 
@@ -1299,7 +1571,7 @@ if __name__ == '__main__':
 
     if os.path.isdir(path):
         # program directory
-        vm_files = list([os.path.join(path, file) for file in os.listdir(path) if file.endswith('.vm')])
+        vm_files = sorted(entry.path for entry in os.scandir(path) if entry.is_file() and entry.name.endswith('.vm'))
         program = os.path.basename(path)
         init_vm = True
         asm_file = os.path.join(path, program + '.asm')
@@ -1312,5 +1584,5 @@ if __name__ == '__main__':
         init_vm = False
         asm_file = os.path.join(dirname, program + '.asm')
 
-    with open(asm_file, 'w') as out:
+    with open(asm_file, 'wb', buffering=1 << 20) as out:
         translate(program, init_vm, vm_files, out)